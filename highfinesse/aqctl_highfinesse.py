@@ -4,17 +4,24 @@
 
 import argparse
 import logging
-import sys
 import os
+import signal
 import asyncio
 
-from highfinesse.driver import HighFinesse
-from sipyco.pc_rpc import simple_server_loop
 from sipyco import common_args
 
 logger = logging.getLogger(__name__)
 
 
+def cpu_index(value):
+    """argparse type for --cpu: a CPU core index usable in an affinity mask."""
+    cpu = int(value)
+    if not 0 <= cpu < 64:
+        raise argparse.ArgumentTypeError(
+            "must be between 0 and 63, not {}".format(cpu))
+    return cpu
+
+
 def get_argparser():
     parser = argparse.ArgumentParser(
         description="ARTIQ controller for the Britton Lab High Finesse wavemeter")
@@ -22,24 +29,103 @@ def get_argparser():
     parser.add_argument(
         "--simulation", action="store_true",
         help="Put the driver in simulation mode, even if --device is used.")
+    parser.add_argument(
+        "--high-priority", action="store_true",
+        help="Run the controller in the Windows HIGH_PRIORITY_CLASS to reduce "
+             "reply jitter.")
+    parser.add_argument(
+        "--cpu", type=cpu_index, default=None,
+        help="Pin the thread talking to the wavemeter to this CPU core "
+             "(0 to 63, Windows only, default: not pinned).")
     common_args.verbosity_args(parser)
     return parser
 
 
-def main():
-    args = get_argparser().parse_args()
-    common_args.init_logger_from_args(args)
+def set_high_priority():
+    """Move this process to HIGH_PRIORITY_CLASS (Windows only)."""
+    if os.name != "nt":
+        logger.warning("--high-priority is only supported on Windows")
+        return
+    from highfinesse.wlm_data import load_kernel32, HIGH_PRIORITY_CLASS
+    kernel32 = load_kernel32()
+    if not kernel32.SetPriorityClass(kernel32.GetCurrentProcess(),
+                                     HIGH_PRIORITY_CLASS):
+        logger.warning("Failed to set process priority class")
+
+
+def install_event_loop():
+    """Use the fastest available event loop implementation."""
+    try:
+        if os.name == "nt":
+            import winloop
+            winloop.install()
+        else:
+            import uvloop
+            uvloop.install()
+    except ImportError:
+        if os.name == "nt":
+            # Not the selector loop: unlike the Proactor it never arms
+            # signal.set_wakeup_fd, so Ctrl-C would wait for socket activity
+            asyncio.set_event_loop_policy(
+                asyncio.WindowsProactorEventLoopPolicy())
+
 
-    if os.name == "nt":
-        asyncio.set_event_loop(asyncio.ProactorEventLoop())
+async def run(args):
+    # Imported here rather than at module level so that argument errors and
+    # --help return without loading the RPC server (and numpy via pyon) or the
+    # cffi bindings.
+    from highfinesse.driver import HighFinesse
+    from sipyco.pc_rpc import Server
 
-    dev = HighFinesse(args.simulation)
-    asyncio.get_event_loop().run_until_complete(dev.init())
+    dev = HighFinesse(args.simulation, cpu=args.cpu)
     try:
-        simple_server_loop(
-            {"HighFinesse": dev}, common_args.bind_address_from_args(args), args.port)
+        await dev.init()
+        server = Server({"HighFinesse": dev}, None, True, allow_parallel=True)
+        await server.start(common_args.bind_address_from_args(args), args.port)
+        try:
+            await wait_terminate(server)
+        finally:
+            await server.stop()
     finally:
         dev.close()
 
+
+async def wait_terminate(server):
+    """Returns when the RPC terminate method is called or on SIGINT/SIGTERM,
+    like sipyco's simple_server_loop."""
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    signals = []
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            # Windows: Ctrl-C instead cancels the asyncio.run() main task
+            continue
+        signals.append(sig)
+    try:
+        tasks = [asyncio.ensure_future(server.wait_terminate()),
+                 asyncio.ensure_future(stop.wait())]
+        _, pending = await asyncio.wait(
+            tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in pending:
+            task.cancel()
+    finally:
+        for sig in signals:
+            loop.remove_signal_handler(sig)
+
+
+def main():
+    args = get_argparser().parse_args()
+    common_args.init_logger_from_args(args)
+
+    if args.high_priority:
+        set_high_priority()
+    install_event_loop()
+    try:
+        asyncio.run(run(args))
+    except KeyboardInterrupt:
+        pass
+
 if __name__ == "__main__":
     main()
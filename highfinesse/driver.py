@@ -3,11 +3,14 @@
 
 import logging
 import asyncio
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
 from highfinesse import wlm_constants as wlm
 from enum import IntEnum
 try:  # permits running in simulation mode on linux
-    from ctypes import windll, c_double, c_ushort, c_long, c_bool, byref, c_short
-    from ctypes import c_char_p, create_string_buffer, pointer
+    from highfinesse.wlm_data import ffi, load, load_kernel32, callback_ex
+    from highfinesse.wlm_data import THREAD_PRIORITY_ABOVE_NORMAL
 except ImportError:
     pass
 
@@ -21,32 +24,93 @@ WavelengthRange = {
 }
 
 
+# Plain int measurement status values, used on the hot return paths
+_STATUS_OKAY = 0
+_STATUS_UNDER = 1
+_STATUS_OVER = 2
+_STATUS_ERROR = 3
+
+
 class WLMMeasurementStatus(IntEnum):
-    OKAY = 0,
-    UNDER_EXPOSED = 1,
-    OVER_EXPOSED = 2,
-    ERROR = 3
+    OKAY = _STATUS_OKAY
+    UNDER_EXPOSED = _STATUS_UNDER
+    OVER_EXPOSED = _STATUS_OVER
+    ERROR = _STATUS_ERROR
+
+
+# GetFrequencyNum error codes that map to a measurement status other than ERROR
+_FREQ_ERR_MAP = {
+    wlm.ErrBigSignal: (_STATUS_OVER, "OVER_EXPOSED"),
+    wlm.ErrLowSignal: (_STATUS_UNDER, "UNDER_EXPOSED"),
+}
+
+# speed of light in nm * THz, to convert pushed wavelengths to frequencies
+_C_NM_THZ = 299792.458
+
+
+def _init_wlm_thread(cpu):
+    """ Initializer of the WLM worker thread: raises its priority so DLL reads
+    are not delayed by other processes, and pins it to CPU core cpu (unless
+    None) so it does not migrate between cores """
+    kernel32 = load_kernel32()
+    thread = kernel32.GetCurrentThread()
+    if not kernel32.SetThreadPriority(thread, THREAD_PRIORITY_ABOVE_NORMAL):
+        logger.warning("Failed to raise WLM worker thread priority")
+    if (cpu is not None
+            and not kernel32.SetThreadAffinityMask(thread, 1 << cpu)):
+        logger.warning("Failed to pin WLM worker thread to CPU %d", cpu)
 
 
 class WLMException(Exception):
     """ Raised on errors involving the WLM interface library (windata.dll) """
     def __init__(self, value):
-        s = 'WLMException: {}'.format(value)
-        logger.error(s)
+        logger.error("WLMException: %s", value)
 
 
 class HighFinesse:
     """Driver for HighFinesse wavemeter used by Britton Lab
     """
-
-    def __init__(self, simulation=False):
+    __slots__ = ("simulation", "lib", "wlm_model", "wlm_hw_rev", "wlm_fw_rev",
+                 "wlm_fw_build", "_num_ccds", "_pool", "_inflight",
+                 "_cache_ttl", "_temp_cache", "_pressure_cache", "_latest",
+                 "_max_push_age", "_callback", "_id", "_cpu",
+                 "_GetFrequencyNum", "_GetTemperature", "_GetPressure",
+                 "_GetWLMVersion")
+
+    def __init__(self, simulation=False, cache_ttl=0.1, cpu=None,
+                 max_push_age=0.1):
+        """
+        :param cache_ttl: time in seconds for which a temperature or pressure
+          reading is reused instead of querying the wavemeter again
+        :param cpu: index (0 to 63) of the CPU core to pin the WLM worker
+          thread to, or None to leave it to the OS scheduler
+        :param max_push_age: maximum age in seconds of a frequency pushed by
+          the WLM server for it to be returned instead of reading the channel
+        """
+        if cpu is not None and not 0 <= cpu < 64:
+            raise ValueError("cpu must be between 0 and 63, not {}".format(cpu))
         self.simulation = simulation
+        self._cpu = cpu
+        self._pool = None
+        # identification string, read once: versions do not change at runtime
+        self._id = None
+        # channel -> pending GetFrequencyNum read, shared by concurrent callers
+        self._inflight = {}
+        # (value, time.monotonic() of reading)
+        self._cache_ttl = cache_ttl
+        self._temp_cache = (0.0, -math.inf)
+        self._pressure_cache = (0.0, -math.inf)
+        # channel -> (time.monotonic(), frequency in THz or error code), kept
+        # up to date by the WLM server through _on_wlm_event
+        self._latest = {}
+        self._max_push_age = max_push_age
+        self._callback = None
         if self.simulation:
             logger.info('simulation mode active')
             return
 
         try:
-            self.lib = lib = windll.wlmData
+            self.lib = lib = load()
         except Exception as e:
             raise WLMException("Failed to load WLM DLL (is HighFinesse software installed?): {}".format(e))
 
@@ -55,28 +119,25 @@ class HighFinesse:
         self.wlm_fw_rev = -1
         self.wlm_fw_build = -1
 
-        # configure DLL function arg/return types
-        lib.Operation.restype = c_long
-        lib.Operation.argtypes = [c_ushort]
-        lib.GetOperationState.restype = c_ushort
-        lib.GetOperationState.argtypes = [c_ushort]
-        lib.GetTemperature.restype = c_double
-        lib.GetTemperature.argtypes = [c_double]
-        lib.GetPressure.restype = c_double
-        lib.GetPressure.argtypes = [c_double]
-        lib.SetExposureModeNum.restype = c_long
-        lib.SetExposureModeNum.argtypes = [c_long, c_bool]
-        lib.GetFrequencyNum.restype = c_double
-        lib.GetFrequencyNum.argtypes = [c_long, c_double]
-        lib.GetPIDCourseNum.argtypes = [c_long, c_char_p]
-        lib.SetPIDCourseNum.argtypes = [c_long, c_char_p]
+        # wlmData.dll is not re-entrant, so all calls into it are serialized
+        # on a single worker thread, off the event loop
+        self._pool = ThreadPoolExecutor(max_workers=1,
+                                        thread_name_prefix="wlm",
+                                        initializer=_init_wlm_thread,
+                                        initargs=(self._cpu,))
 
+        # DLL function arg/return types are declared once in wlm_data; bind
+        # the hot-path functions here so each read is a direct cffi call
+        self._GetFrequencyNum = lib.GetFrequencyNum
+        self._GetTemperature = lib.GetTemperature
+        self._GetPressure = lib.GetPressure
+        self._GetWLMVersion = lib.GetWLMVersion
 
         # Check the WLM server application is running and start it if necessary
-        if not lib.Instantiate(wlm.cInstCheckForWLM, 0, 0, 0):
+        if not lib.Instantiate(wlm.cInstCheckForWLM, 0, ffi.NULL, 0):
             logger.info("Starting WLM server")
             res = lib.ControlWLMEx(wlm.cCtrlWLMShow | wlm.cCtrlWLMWait,
-                                   0, 0, 10000, 1)
+                                   ffi.NULL, 0, 10000, 1)
             codes = wlm.control_wlm_to_str(res)
             if "flServerStarted" not in codes:
                 raise WLMException("Error starting WLM server application : "
@@ -84,29 +145,75 @@ class HighFinesse:
             for code in codes:
                 if code == "flServerStarted":
                     continue
-                logger.warning("Unexpected return code from ControlWLMEx: {} "
-                               .format(code))
+                logger.warning("Unexpected return code from ControlWLMEx: %s ",
+                               code)
 
         logger.info("Connected to WLM server")
-        self.id()
+
+        # Have the WLM server push new measurements instead of polling it;
+        # the cdata callback must stay referenced while installed
+        self._callback = ffi.callback(callback_ex, self._on_wlm_event)
+        if not lib.Instantiate(wlm.cInstNotification,
+                               wlm.cNotifyInstallCallbackEx,
+                               ffi.cast("long *", self._callback), 0):
+            logger.warning("Failed to install WLM callback, frequencies will "
+                           "be polled")
+            self._callback = None
+
+    def _on_wlm_event(self, ver, mode, int_val, dbl_val, res1):
+        """ CallbackProcEx, called from a WLM server thread on every event """
+        ch = wlm.wavelength_event_channels.get(mode)
+        if ch is None:
+            return
+        # dbl_val is the wavelength in nm, or a (negative) error code
+        freq = _C_NM_THZ / dbl_val if dbl_val > 0 else dbl_val
+        self._latest[ch] = (time.monotonic(), freq)
+
+    def _pushed_frequency(self, ch, now):
+        """ Returns the last frequency pushed for channel ch if it is fresh,
+        otherwise None """
+        entry = self._latest.get(ch)
+        if entry is not None and now - entry[0] < self._max_push_age:
+            return entry[1]
+        return None
 
     def close(self):
         """Do what's needed to close. """
+        # wait for any in-flight read first, so the DLL is never called from
+        # two threads at once
+        if self._pool is not None:
+            self._pool.shutdown()
+        if self._callback is not None:
+            self.lib.Instantiate(wlm.cInstNotification,
+                                 wlm.cNotifyRemoveCallback, ffi.NULL, 0)
+            self._callback = None
 
     async def init(self):
         """Hook for async loop."""
-        pass
+        if self.simulation:
+            return
+
+        await self.id()
+
+    async def _run(self, fn, *args):
+        """ Runs the blocking DLL call fn(*args) on the WLM worker thread.
+
+        cffi releases the GIL for the duration of every call into the DLL, so
+        the event loop keeps serving cached and pushed readings meanwhile.
+        """
+        return await asyncio.get_running_loop().run_in_executor(
+            self._pool, fn, *args)
 
     async def id(self):
         """ :returns: WLM identification string """
         if self.simulation:
             return "WLM simulator"
+        if self._id is not None:
+            return self._id
 
         """Sends the id command and prints output."""
-        self.wlm_model = self.lib.GetWLMVersion(0)
-        self.wlm_hw_rev = self.lib.GetWLMVersion(1)
-        self.wlm_fw_rev = self.lib.GetWLMVersion(2)
-        self.wlm_fw_build = self.lib.GetWLMVersion(3)
+        (self.wlm_model, self.wlm_hw_rev, self.wlm_fw_rev,
+         self.wlm_fw_build) = await self._run(self._read_versions)
 
         if self.wlm_model < 5 or self.wlm_model > 10:
             raise WLMException("Unrecognised WLM model: {}".format(
@@ -115,23 +222,28 @@ class HighFinesse:
         # WS/6 have 1, WS/7 & WS/8 & WS/U have 2
         self._num_ccds = 2 if self.wlm_model >= 7 else 1
 
-        return "WLM {} rev {}, firmware {}.{}".format(
+        self._id = "WLM {} rev {}, firmware {}.{}".format(
             self.wlm_model, self.wlm_hw_rev, self.wlm_fw_rev,
             self.wlm_fw_build)
+        return self._id
 
-    async def get_status(self):
-        """Hook for async loop."""
+    def _read_versions(self):
+        """ Reads model, hardware revision, firmware revision and build on the
+        WLM worker thread """
+        get_wlm_version = self._GetWLMVersion
+        return tuple(get_wlm_version(i) for i in range(4))
+
+    def get_status(self):
+        """Hook for status queries."""
         # TODO implement this
         pass
 
-    async def ping(self):
+    def ping(self):
         if self.simulation:
             logger.debug('ping simulation')
             return True
         try:
-            await self.get_status()
-        except asyncio.CancelledError:
-            raise
+            self.get_status()
         except Exception:
             raise WLMException('ping failed')
             return False
@@ -143,10 +255,16 @@ class HighFinesse:
         if self.simulation:
             return 25.0
 
-        temp = self.lib.GetTemperature(0)
+        now = time.monotonic()
+        temp, t = self._temp_cache
+        if now - t < self._cache_ttl:
+            return temp
+
+        temp = await self._run(self._GetTemperature, 0.0)
         if temp < 0:
             raise WLMException(
                 "Error reading WLM temperature: {}".format(temp))
+        self._temp_cache = (temp, now)
         return temp
 
     async def get_pressure(self):
@@ -157,10 +275,16 @@ class HighFinesse:
         if self.simulation:
             return 1013.25
 
-        pressure = self.lib.GetPressure(0)
+        now = time.monotonic()
+        pressure, t = self._pressure_cache
+        if now - t < self._cache_ttl:
+            return pressure
+
+        pressure = await self._run(self._GetPressure, 0.0)
         if pressure < 0:
             raise WLMException(
                 "Error reading WLM pressure: {}". format(pressure))
+        self._pressure_cache = (pressure, now)
         return pressure
 
     async def get_frequency(self, ch):
@@ -171,30 +295,74 @@ class HighFinesse:
           WLMMeasurementStatus and frequency is in Hz.
         """
         if self.simulation:
-            return WLMMeasurementStatus.OKAY.value, 123.456789e12
+            return _STATUS_OKAY, 123.456789e12
+
+        freq = self._pushed_frequency(ch, time.monotonic())
+        if freq is not None:
+            return self._decode_frequency(ch, freq)
 
         # this should never time out, but it does...
         # I've had a long discussion with the HF engineers about why this
         # occurs on some units, without any real success.
         try:
             # self._get_fresh_data()
-            freq = self.lib.GetFrequencyNum(ch, 0)
+            freq = await asyncio.shield(self._read_frequency(ch))
         except WLMException as e:
-            logger.error("error during frequency read: {}".format(e))
-            return WLMMeasurementStatus.ERROR.value, 0
-
+            logger.error("error during frequency read: %s", e)
+            return _STATUS_ERROR, 0
+
+        return self._decode_frequency(ch, freq)
+
+    def _read_frequency(self, ch):
+        """ Returns the pending read of channel ch, starting one if there is
+        none, so that concurrent get_frequency calls share one DLL call """
+        fut = self._inflight.get(ch)
+        if fut is None:
+            fut = asyncio.get_running_loop().run_in_executor(
+                self._pool, self._GetFrequencyNum, ch, 0.0)
+            self._inflight[ch] = fut
+            fut.add_done_callback(lambda _: self._inflight.pop(ch, None))
+        return fut
+
+    async def get_frequencies(self, channels):
+        """ Returns the frequencies of several channels in one call.
+        channels is a sequence of mems mirror channels
+
+        :returns: a list of (status, frequency) tuples, one per channel, as
+          returned by get_frequency.
+        """
+        if self.simulation:
+            return [(_STATUS_OKAY, 123.456789e12)
+                    for _ in channels]
+
+        now = time.monotonic()
+        freqs = [self._pushed_frequency(ch, now) for ch in channels]
+        stale = [ch for ch, freq in zip(channels, freqs) if freq is None]
+        if stale:
+            read = iter(await self._run(self._read_frequencies, stale))
+            freqs = [next(read) if freq is None else freq for freq in freqs]
+
+        return [self._decode_frequency(ch, freq)
+                for ch, freq in zip(channels, freqs)]
+
+    def _read_frequencies(self, channels):
+        """ Reads all channels back to back on the WLM worker thread """
+        get_frequency_num = self._GetFrequencyNum
+        return [get_frequency_num(ch, 0.0) for ch in channels]
+
+    def _decode_frequency(self, ch, freq):
+        """ Converts a GetFrequencyNum return value to (status, frequency) """
         if freq > 0:
-            return WLMMeasurementStatus.OKAY.value, freq * 1e12
-        elif freq == wlm.ErrBigSignal:
-            logger.warning("OVER_EXPOSED: ch {}".format(ch))
-            return WLMMeasurementStatus.OVER_EXPOSED.value, 0
-        elif freq == wlm.ErrLowSignal:
-            logger.warning("UNDER_EXPOSED: ch {}".format(ch))
-            return WLMMeasurementStatus.UNDER_EXPOSED.value, 0
-        else:
-            logger.error("error getting frequency: {}"
-                         .format(wlm.error_to_str(freq)))
-            return WLMMeasurementStatus.ERROR.value, 0
+            return _STATUS_OKAY, freq * 1e12
+
+        entry = _FREQ_ERR_MAP.get(freq)
+        if entry is not None:
+            status, name = entry
+            logger.warning("%s: ch %s", name, ch)
+            return status, 0
+
+        logger.error("error getting frequency: %s", wlm.error_to_str(freq))
+        return _STATUS_ERROR, 0
 
     async def get_pid_course_num(self, analog_port):
         """ Returns the PID regulation course of the PID regulation function.
@@ -203,16 +371,16 @@ class HighFinesse:
         :returns: status message
         """
         if self.simulation:
-            return WLMMeasurementStatus.OKAY.value, 123.456789e12
+            return _STATUS_OKAY, 123.456789e12
 
         try:
-            s = create_string_buffer(1024)
-            r = self.lib.GetPIDCourseNum(analog_port, s)
+            s = ffi.new("char[]", 1024)
+            r = await self._run(self.lib.GetPIDCourseNum, analog_port, s)
         except WLMException as e:
-            logger.error("error during get_pid_course_num: {}".format(e))
-            return WLMMeasurementStatus.ERROR.value, 0
+            logger.error("error during get_pid_course_num: %s", e)
+            return _STATUS_ERROR, 0
 
-        return s.value
+        return ffi.string(s)
 
     async def set_pid_course_num(self, analog_port_num, course_string):
         """ Returns the PID regulation course of the PID regulation function.
@@ -222,13 +390,13 @@ class HighFinesse:
         :returns: status message
         """
         if self.simulation:
-            return WLMMeasurementStatus.OKAY.value, 123.456789e12
+            return _STATUS_OKAY, 123.456789e12
 
         try:
-            sb = create_string_buffer(course_string.encode('ascii'), 1024)
-            r = self.lib.SetPIDCourseNum(analog_port_num, sb)
+            sb = ffi.new("char[1024]", course_string.encode('ascii'))
+            r = await self._run(self.lib.SetPIDCourseNum, analog_port_num, sb)
         except WLMException as e:
-            logger.error("error during get_pid_course_num: {}".format(e))
-            return WLMMeasurementStatus.ERROR.value, 0
+            logger.error("error during get_pid_course_num: %s", e)
+            return _STATUS_ERROR, 0
 
-        return sb.value
+        return ffi.string(sb)
@@ -500,6 +500,11 @@ event_codes[0] = "NoEvent"
 wavelength_events = [code for event, code in globals().items()
                      if event.startswith("cmi") and ("Wavelength" in event)]
 
+wavelength_event_channels = {
+    code: int(event[len("cmiWavelength"):])
+    for event, code in globals().items() if event.startswith("cmiWavelength")
+}
+
 errors = {
     code: name[7:] for name, code in globals().items()
     if name.startswith("ResERR_")
@@ -0,0 +1,61 @@
+""" cffi bindings for the subset of wlmData.dll used by the driver, as
+supplied by HighFinesse with the WS*- and LSA-series devices, plus the few
+kernel32 calls used to tune the thread that talks to it. """
+
+from cffi import FFI
+
+# Prototypes as given in wlmData.h (C flavour, where lref is long*). cffi,
+# both ABI mode and the compiled extension, drops the GIL around each call.
+cdef = """
+long* WINAPI Instantiate(long RFC, long Mode, long* P1, long P2);
+long WINAPI ControlWLMEx(long Action, long* App, long Ver, long Delay,
+                         long Res);
+long WINAPI GetWLMVersion(long Ver);
+long WINAPI Operation(unsigned short Op);
+unsigned short WINAPI GetOperationState(unsigned short I);
+double WINAPI GetTemperature(double T);
+double WINAPI GetPressure(double P);
+long WINAPI SetExposureModeNum(long num, bool EM);
+double WINAPI GetFrequencyNum(long num, double F);
+long WINAPI GetPIDCourseNum(long Port, char* PIDC);
+long WINAPI SetPIDCourseNum(long Port, char* PIDC);
+"""
+
+kernel32_cdef = """
+void* WINAPI GetCurrentThread(void);
+void* WINAPI GetCurrentProcess(void);
+int WINAPI SetThreadPriority(void* hThread, int nPriority);
+uintptr_t WINAPI SetThreadAffinityMask(void* hThread,
+                                       uintptr_t dwThreadAffinityMask);
+int WINAPI SetPriorityClass(void* hProcess, unsigned long dwPriorityClass);
+"""
+
+# kernel32 priority values (winbase.h)
+THREAD_PRIORITY_ABOVE_NORMAL = 1
+HIGH_PRIORITY_CLASS = 0x00000080
+
+# Signature of the CallbackProcEx installed with cNotifyInstallCallbackEx
+callback_ex = "void(__stdcall *)(long, long, long, double, long)"
+
+try:  # C extension built by setup.py when WLMDATA_SDK is set
+    from highfinesse._wlm_data import ffi, lib as _compiled_lib
+except ImportError:
+    ffi = FFI()
+    ffi.cdef(cdef)
+    _compiled_lib = None
+
+_kernel32_ffi = FFI()
+_kernel32_ffi.cdef(kernel32_cdef)
+
+
+def load(name="wlmData.dll"):
+    """ Returns the cffi lib object of the WLM interface library: the compiled
+    extension if available, otherwise the DLL opened in ABI mode """
+    if _compiled_lib is not None:
+        return _compiled_lib
+    return ffi.dlopen(name)
+
+
+def load_kernel32():
+    """ Opens kernel32.dll and returns its cffi lib object """
+    return _kernel32_ffi.dlopen("kernel32.dll")
@@ -1,13 +1,22 @@
+import os
 from setuptools import setup, find_packages
 
+# The compiled wlmData bindings are optional: only build them when pointed at
+# the wlmData SDK (see wlm_data_build.py)
+extra = {}
+if os.environ.get("WLMDATA_SDK"):
+    extra = dict(setup_requires=["cffi"],
+                 cffi_modules=["wlm_data_build.py:ffibuilder"])
+
 setup(
     name="highfinesse",
-    install_requires=["sipyco"],
+    install_requires=["sipyco", "cffi; sys_platform == 'win32'"],
     packages=find_packages(),
     entry_points={
         "console_scripts": [
             "aqctl_highfinesse = highfinesse.aqctl_highfinesse:main",
         ],
     },
+    **extra
 )
 
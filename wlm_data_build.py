@@ -0,0 +1,25 @@
+""" cffi API-mode builder for highfinesse._wlm_data, a C extension calling
+wlmData.dll directly instead of through libffi.
+
+Needs the wlmData SDK installed with the HighFinesse software: set
+WLMDATA_SDK to the directory holding wlmData.h and wlmData.lib. """
+
+import os
+
+from cffi import FFI
+
+from highfinesse.wlm_data import cdef
+
+sdk = os.environ.get("WLMDATA_SDK")
+if not sdk:
+    raise RuntimeError("WLMDATA_SDK must be set to the directory holding "
+                       "wlmData.h and wlmData.lib")
+
+ffibuilder = FFI()
+ffibuilder.cdef(cdef)
+ffibuilder.set_source("highfinesse._wlm_data", '#include "wlmData.h"',
+                      include_dirs=[sdk], library_dirs=[sdk],
+                      libraries=["wlmData"])
+
+if __name__ == "__main__":
+    ffibuilder.compile(verbose=True)